@@ -1,14 +1,20 @@
 import os
-import requests
+import asyncio
+import httpx
+import websockets
 import datetime
 import base64
 import time
 import math
+import orjson
+import functools
+import itertools
+import operator
+from dataclasses import dataclass
 from typing import List, Dict, Optional
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography.hazmat.backends import default_backend
-from supabase import create_client, Client
 
 
 # ==========================================================
@@ -17,11 +23,29 @@ from supabase import create_client, Client
 
 API_KEY_ID = os.getenv("KALSHI_API_KEY_ID")
 BASE_URL = "https://api.elections.kalshi.com"
+WS_URL = "wss://api.elections.kalshi.com/trade-api/ws/v2"
+WS_PATH = "/trade-api/ws/v2"
+WS_RECONNECT_DELAY = 5
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
 TABLE_NAME = "kalshi_high_snapshots"
+INSERT_CHUNK_SIZE = 500
+INSERT_CONNECTIONS = 4
+INSERT_QUEUE_SIZE = 100
+
+BID_KEYS = [(f"bid{i+1}_price", f"bid{i+1}_qty") for i in range(5)]
+ASK_KEYS = [(f"ask{i+1}_price", f"ask{i+1}_qty") for i in range(5)]
+
+MAX_CONCURRENT_REQUESTS = 20
+MAX_CONNECTIONS = 64
+REQUEST_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.2
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+METADATA_TTL = 1800
+METADATA_CACHE_SIZE = 512
 
 SERIES_TICKERS = [
     "KXHIGHNY", "KXHIGHMIA", "KXHIGHAUS", "KXHIGHCHI",
@@ -47,21 +71,27 @@ def load_private_key_from_env():
         backend=default_backend()
     )
 
-def sign_message(private_key: rsa.RSAPrivateKey, message: str) -> str:
-    signature = private_key.sign(
-        message.encode(),
-        padding.PSS(
-            mgf=padding.MGF1(hashes.SHA256()),
-            salt_length=padding.PSS.DIGEST_LENGTH
-        ),
-        hashes.SHA256()
-    )
+PSS_PADDING = padding.PSS(
+    mgf=padding.MGF1(hashes.SHA256()),
+    salt_length=padding.PSS.DIGEST_LENGTH
+)
+
+def sign_message(private_key: rsa.RSAPrivateKey, message: bytes) -> str:
+    signature = private_key.sign(message, PSS_PADDING, hashes.SHA256())
     return base64.b64encode(signature).decode()
 
-def get_headers(method: str, path: str, private_key):
-    timestamp = str(int(datetime.datetime.now(datetime.UTC).timestamp() * 1000))
+PRIVATE_KEY = load_private_key_from_env() if os.getenv("KALSHI_PRIVATE_KEY") else None
+
+def current_auth_timestamp() -> str:
+    return str(time.time_ns() // 1_000_000)
+
+def get_headers(method: str, path: str, private_key, timestamp: str):
     path_without_query = path.split("?")[0]
-    message = timestamp + method + path_without_query
+    return sign_request(method, path_without_query, private_key, timestamp)
+
+@functools.lru_cache(maxsize=1024)
+def sign_request(method: str, path_without_query: str, private_key, timestamp: str):
+    message = f"{timestamp}{method}{path_without_query}".encode("ascii")
     signature = sign_message(private_key, message)
 
     return {
@@ -75,23 +105,266 @@ def get_headers(method: str, path: str, private_key):
 # API FETCHERS
 # ==========================================================
 
-def get_open_events(series, private_key):
-    path = f"/trade-api/v2/events?series_ticker={series}&status=open&limit=100"
-    headers = get_headers("GET", path, private_key)
-    r = requests.get(BASE_URL + path, headers=headers)
-    return r.json().get("events", [])
+def create_session():
+    # With HTTP/2 every request is multiplexed over one connection to Kalshi;
+    # the connection limit only matters if the server falls back to HTTP/1.1.
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+    return httpx.AsyncClient(http2=True, limits=limits, timeout=REQUEST_TIMEOUT)
+
+async def fetch(session, path, private_key, timestamp, extra_headers=None):
+    headers = get_headers("GET", path, private_key, timestamp)
+    if extra_headers:
+        headers = {**headers, **extra_headers}
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            r = await session.get(BASE_URL + path, headers=headers)
+            if r.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                return r
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                raise
+        await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+
+async def fetch_json(session, path, private_key, timestamp):
+    return orjson.loads((await fetch(session, path, private_key, timestamp)).content)
+
+# Event/market listings are cached for METADATA_TTL seconds, and never past
+# 00:00 UTC since the daily-high contracts roll over at midnight.
+METADATA_CACHE: Dict[tuple, tuple] = {}
+
+def metadata_expiry():
+    now = datetime.datetime.now(datetime.UTC)
+    midnight = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return min(now.timestamp() + METADATA_TTL, midnight.timestamp())
+
+def get_cached_metadata(key):
+    entry = METADATA_CACHE.get(key)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+    return None
+
+def cache_metadata(key, value):
+    if not value:
+        return
+    if key not in METADATA_CACHE and len(METADATA_CACHE) >= METADATA_CACHE_SIZE:
+        now = time.time()
+        for stale_key in [k for k, (expires, _) in METADATA_CACHE.items() if expires <= now]:
+            del METADATA_CACHE[stale_key]
+        if len(METADATA_CACHE) >= METADATA_CACHE_SIZE:
+            del METADATA_CACHE[min(METADATA_CACHE, key=lambda k: METADATA_CACHE[k][0])]
+    METADATA_CACHE[key] = (metadata_expiry(), value)
+
+async def get_open_events(session, series, private_key, timestamp):
+    events = get_cached_metadata(("events", series))
+    if events is None:
+        path = f"/trade-api/v2/events?series_ticker={series}&status=open&limit=100"
+        events = (await fetch_json(session, path, private_key, timestamp)).get("events", [])
+        cache_metadata(("events", series), events)
+    return events
+
+async def get_open_markets(session, event_ticker, private_key, timestamp):
+    markets = get_cached_metadata(("markets", event_ticker))
+    if markets is None:
+        path = f"/trade-api/v2/markets?event_ticker={event_ticker}&status=open&limit=100"
+        markets = (await fetch_json(session, path, private_key, timestamp)).get("markets", [])
+        cache_metadata(("markets", event_ticker), markets)
+    return markets
+
+def orderbook_path(market_ticker):
+    return f"/trade-api/v2/markets/{market_ticker}/orderbook"
+
+# Last ETag and parsed orderbook per path, so unchanged books come back as
+# a bodiless 304 and reuse the previous parse.
+ETAG_CACHE: Dict[str, str] = {}
+ORDERBOOK_CACHE: Dict[str, dict] = {}
+
+def prune_orderbook_cache(market_tickers):
+    current = {orderbook_path(ticker) for ticker in market_tickers}
+    for path in list(ETAG_CACHE):
+        if path not in current:
+            ETAG_CACHE.pop(path, None)
+            ORDERBOOK_CACHE.pop(path, None)
+
+async def get_orderbook(session, market_ticker, private_key, timestamp):
+    path = orderbook_path(market_ticker)
+    etag = ETAG_CACHE.get(path)
+    extra_headers = {"If-None-Match": etag} if etag else None
+
+    r = await fetch(session, path, private_key, timestamp, extra_headers)
+
+    if r.status_code == 304 and path in ORDERBOOK_CACHE:
+        return ORDERBOOK_CACHE[path]
+
+    orderbook = orjson.loads(r.content).get("orderbook", {}) or {}
+
+    etag = r.headers.get("ETag")
+    if r.status_code == 200 and etag:
+        ETAG_CACHE[path] = etag
+        ORDERBOOK_CACHE[path] = orderbook
+
+    return orderbook
+
+async def bounded(semaphore, coro):
+    async with semaphore:
+        return await coro
+
+
+# ==========================================================
+# ORDERBOOK STREAM
+# ==========================================================
+
+# market ticker -> {"yes": {price: qty}, "no": {price: qty}}, only for
+# markets whose snapshot has arrived on the current connection
+ORDERBOOKS: Dict[str, Dict[str, Dict[int, int]]] = {}
+# Tickers from the latest listing; resubscribed in full on every reconnect.
+SUBSCRIBED_TICKERS: set = set()
+# Tickers subscribed on the live connection, and the sid Kalshi assigned
+# to each once the subscribe is acknowledged. A ticker leaves
+# STREAM_TICKERS only after it has been removed from its sid, so it is
+# never subscribed twice.
+STREAM_TICKERS: set = set()
+TICKER_SIDS: Dict[str, int] = {}
+PENDING_SUBSCRIBES: Dict[int, list] = {}
+STREAM_SEQ: Dict[int, int] = {}
+STREAM_COMMAND_IDS = itertools.count(1)
+stream_ws: Optional[websockets.ClientConnection] = None
+
+async def send_command(ws, cmd, params):
+    command_id = next(STREAM_COMMAND_IDS)
+    # decoded so the command goes out as a text frame
+    await ws.send(orjson.dumps({"id": command_id, "cmd": cmd, "params": params}).decode())
+    return command_id
+
+async def send_subscribe(ws, market_tickers):
+    STREAM_TICKERS.update(market_tickers)
+    command_id = await send_command(ws, "subscribe", {
+        "channels": ["orderbook_delta"],
+        "market_tickers": market_tickers
+    })
+    PENDING_SUBSCRIBES[command_id] = market_tickers
+
+async def send_unsubscribe(ws, market_tickers):
+    by_sid: Dict[int, list] = {}
+    for ticker in market_tickers:
+        sid = TICKER_SIDS.get(ticker)
+        if sid is not None:
+            by_sid.setdefault(sid, []).append(ticker)
+
+    # Tickers whose subscribe hasn't been acknowledged yet stay in
+    # STREAM_TICKERS and are retried on the next snapshot.
+    for sid, tickers in by_sid.items():
+        await send_command(ws, "update_subscription", {
+            "sids": [sid],
+            "market_tickers": tickers,
+            "action": "delete_markets"
+        })
+        for ticker in tickers:
+            STREAM_TICKERS.discard(ticker)
+            TICKER_SIDS.pop(ticker, None)
+
+async def subscribe_markets(market_tickers):
+    current = set(market_tickers)
+
+    SUBSCRIBED_TICKERS.clear()
+    SUBSCRIBED_TICKERS.update(current)
+
+    new_tickers = current - STREAM_TICKERS
+    removed_tickers = STREAM_TICKERS - current
+
+    for ticker in removed_tickers:
+        ORDERBOOKS.pop(ticker, None)
+
+    if stream_ws is None:
+        return
+
+    # If the socket just dropped, the reconnect resubscribes the listing.
+    try:
+        if removed_tickers:
+            await send_unsubscribe(stream_ws, sorted(removed_tickers))
+        if new_tickers:
+            await send_subscribe(stream_ws, sorted(new_tickers))
+    except websockets.ConnectionClosed as e:
+        print("Orderbook stream closed during subscribe:", e)
+
+def apply_stream_message(message):
+    sid = message.get("sid")
+    seq = message.get("seq")
+
+    if seq is not None:
+        last_seq = STREAM_SEQ.get(sid)
+        if last_seq is not None and seq != last_seq + 1:
+            raise ConnectionError(f"Orderbook stream sequence gap on sid {sid}: {last_seq} -> {seq}")
+        STREAM_SEQ[sid] = seq
+
+    msg_type = message.get("type")
+    msg = message.get("msg") or {}
+    market_ticker = msg.get("market_ticker")
+
+    if msg_type == "orderbook_snapshot":
+        if market_ticker in STREAM_TICKERS and market_ticker in SUBSCRIBED_TICKERS:
+            ORDERBOOKS[market_ticker] = {
+                "yes": {p: q for p, q in msg.get("yes") or []},
+                "no": {p: q for p, q in msg.get("no") or []}
+            }
+
+    elif msg_type == "orderbook_delta":
+        book = ORDERBOOKS.get(market_ticker)
+        if book is None:
+            return
+        side = book[msg["side"]]
+        qty = side.get(msg["price"], 0) + msg["delta"]
+        if qty > 0:
+            side[msg["price"]] = qty
+        else:
+            side.pop(msg["price"], None)
+
+    elif msg_type == "subscribed":
+        for ticker in PENDING_SUBSCRIBES.pop(message.get("id"), []):
+            TICKER_SIDS[ticker] = msg.get("sid")
+
+    elif msg_type == "error":
+        print("Orderbook stream error message:", msg)
+
+def get_streamed_orderbook(market_ticker):
+    book = ORDERBOOKS.get(market_ticker)
+    if book is None:
+        return None
+    return {
+        "yes": sorted(book["yes"].items()),
+        "no": sorted(book["no"].items())
+    }
+
+async def run_orderbook_stream():
+    global stream_ws
+
+    while True:
+        try:
+            private_key = PRIVATE_KEY or load_private_key_from_env()
+            headers = get_headers("GET", WS_PATH, private_key, current_auth_timestamp())
+
+            async with websockets.connect(WS_URL, additional_headers=headers, ping_interval=30) as ws:
+                stream_ws = ws
+                STREAM_TICKERS.clear()
+                TICKER_SIDS.clear()
+                PENDING_SUBSCRIBES.clear()
+                if SUBSCRIBED_TICKERS:
+                    await send_subscribe(ws, sorted(SUBSCRIBED_TICKERS))
 
-def get_open_markets(event_ticker, private_key):
-    path = f"/trade-api/v2/markets?event_ticker={event_ticker}&status=open&limit=100"
-    headers = get_headers("GET", path, private_key)
-    r = requests.get(BASE_URL + path, headers=headers)
-    return r.json().get("markets", [])
+                async for ws_message in ws:
+                    apply_stream_message(orjson.loads(ws_message))
 
-def get_orderbook(market_ticker, private_key):
-    path = f"/trade-api/v2/markets/{market_ticker}/orderbook"
-    headers = get_headers("GET", path, private_key)
-    r = requests.get(BASE_URL + path, headers=headers)
-    return r.json().get("orderbook", {}) or {}
+        except Exception as e:
+            print("Orderbook stream error:", e)
+
+        finally:
+            stream_ws = None
+            ORDERBOOKS.clear()
+            STREAM_TICKERS.clear()
+            TICKER_SIDS.clear()
+            PENDING_SUBSCRIBES.clear()
+            STREAM_SEQ.clear()
+
+        await asyncio.sleep(WS_RECONNECT_DELAY)
 
 
 # ==========================================================
@@ -103,133 +376,289 @@ def extract_depth(orderbook):
     yes_raw = orderbook.get("yes") or []
     no_raw = orderbook.get("no") or []
 
-    yes_bids = list(reversed(yes_raw))[:5]
-    no_bids = list(reversed(no_raw))[:5]
+    yes_bids = yes_raw[:-6:-1]
+    no_bids = no_raw[:-6:-1]
 
-    yes_asks = sorted([[100 - p, q] for p, q in no_bids], key=lambda x: x[0])[:5]
+    # Kalshi returns each side ascending by price, so the best NO bids
+    # reversed map to YES asks that are already ascending. Sort only if a
+    # book ever arrives out of order.
+    yes_asks = [[100 - p, q] for p, q in no_bids]
+
+    if any(a[0] > b[0] for a, b in zip(yes_asks, yes_asks[1:])):
+        yes_asks.sort(key=operator.itemgetter(0))
 
     return yes_bids, yes_asks
 
 
+# ==========================================================
+# SUPABASE WRITES
+# ==========================================================
+
+@dataclass(slots=True)
+class SnapshotRow:
+    timestamp_utc: str
+    event: str
+    market: str
+    bucket_type: Optional[str]
+    lower_bound: Optional[int]
+    upper_bound: Optional[int]
+    order: int
+    bid1_price: Optional[int] = None
+    bid1_qty: Optional[int] = None
+    bid2_price: Optional[int] = None
+    bid2_qty: Optional[int] = None
+    bid3_price: Optional[int] = None
+    bid3_qty: Optional[int] = None
+    bid4_price: Optional[int] = None
+    bid4_qty: Optional[int] = None
+    bid5_price: Optional[int] = None
+    bid5_qty: Optional[int] = None
+    ask1_price: Optional[int] = None
+    ask1_qty: Optional[int] = None
+    ask2_price: Optional[int] = None
+    ask2_qty: Optional[int] = None
+    ask3_price: Optional[int] = None
+    ask3_qty: Optional[int] = None
+    ask4_price: Optional[int] = None
+    ask4_qty: Optional[int] = None
+    ask5_price: Optional[int] = None
+    ask5_qty: Optional[int] = None
+
+# Rows go straight to PostgREST, serialized with orjson, rather than
+# through supabase-py's insert builder.
+SUPABASE: Optional[httpx.AsyncClient] = httpx.AsyncClient(
+    base_url=f"{SUPABASE_URL}/rest/v1",
+    headers={
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "Content-Type": "application/json",
+        "Prefer": "return=minimal"
+    },
+    limits=httpx.Limits(max_connections=INSERT_CONNECTIONS),
+    timeout=REQUEST_TIMEOUT
+) if SUPABASE_URL and SUPABASE_KEY else None
+
+async def insert_chunk(supabase, rows):
+    r = await supabase.post(f"/{TABLE_NAME}", content=orjson.dumps(rows))
+    r.raise_for_status()
+
+async def insert_rows_from_queue(supabase, queue):
+    # Each queue item is one event's rows; None ends the tick. Whatever has
+    # queued up is sent as soon as the queue goes idle (or the batch reaches
+    # INSERT_CHUNK_SIZE), so events finishing while an insert is in flight
+    # ride along in the next one.
+    inserted = 0
+    done = False
+
+    while not done:
+        batch = []
+        event_rows = await queue.get()
+
+        while True:
+            if event_rows is None:
+                done = True
+                break
+            batch.extend(event_rows)
+            if len(batch) >= INSERT_CHUNK_SIZE or queue.empty():
+                break
+            event_rows = queue.get_nowait()
+
+        if batch:
+            await insert_chunk(supabase, batch)
+            inserted += len(batch)
+
+    return inserted
+
+
 # ==========================================================
 # MAIN SNAPSHOT LOGIC
 # ==========================================================
 
-def run_snapshot():
+def fill_depth(row, orderbook):
+
+    yes_bids, yes_asks = extract_depth(orderbook)
+
+    for (price_key, qty_key), (price, qty) in itertools.zip_longest(BID_KEYS, yes_bids, fillvalue=(None, None)):
+        setattr(row, price_key, price)
+        setattr(row, qty_key, qty)
+
+    for (price_key, qty_key), (price, qty) in itertools.zip_longest(ASK_KEYS, yes_asks, fillvalue=(None, None)):
+        setattr(row, price_key, price)
+        setattr(row, qty_key, qty)
+
+async def produce_event_rows(session, semaphore, queue, event_rows, private_key, timestamp):
+
+    orderbooks = [get_streamed_orderbook(market_ticker) for market_ticker, _ in event_rows]
+
+    async with asyncio.TaskGroup() as fetches:
+        fetched = {
+            i: fetches.create_task(bounded(semaphore, get_orderbook(
+                session, event_rows[i][0], private_key, timestamp
+            )))
+            for i, orderbook in enumerate(orderbooks) if orderbook is None
+        }
+
+    for i, task in fetched.items():
+        orderbooks[i] = task.result()
+
+    for (_, row), orderbook in zip(event_rows, orderbooks):
+        fill_depth(row, orderbook)
+
+    await queue.put([row for _, row in event_rows])
+
+async def produce_rows(session, semaphore, queue, pending_events, private_key, timestamp):
 
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-    private_key = load_private_key_from_env()
+    async with asyncio.TaskGroup() as events:
+        for event_rows in pending_events:
+            if event_rows:
+                events.create_task(produce_event_rows(
+                    session, semaphore, queue, event_rows, private_key, timestamp
+                ))
+
+    await queue.put(None)
+
+def first_error(error):
+    while isinstance(error, BaseExceptionGroup):
+        error = error.exceptions[0]
+    return error
+
+async def run_snapshot(session):
+
+    if not SUPABASE_URL:
+        raise ValueError("Missing SUPABASE_URL environment variable")
+    if not SUPABASE_KEY:
+        raise ValueError("Missing SUPABASE_KEY environment variable")
+    supabase = SUPABASE
+    private_key = PRIVATE_KEY or load_private_key_from_env()
 
     timestamp = datetime.datetime.now(datetime.UTC).isoformat()
+    auth_timestamp = current_auth_timestamp()
 
-    rows_to_insert = []
+    pending_events = []
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-    for series in SERIES_TICKERS:
+    events_by_series = await asyncio.gather(*[
+        bounded(semaphore, get_open_events(session, series, private_key, auth_timestamp))
+        for series in SERIES_TICKERS
+    ])
 
-        events = get_open_events(series, private_key)
+    event_tickers = [
+        event.get("event_ticker") or event.get("ticker")
+        for events in events_by_series
+        for event in events
+    ]
 
-        for event in events:
+    markets_by_event = await asyncio.gather(*[
+        bounded(semaphore, get_open_markets(session, event_ticker, private_key, auth_timestamp))
+        for event_ticker in event_tickers
+    ])
 
-            event_ticker = event.get("event_ticker") or event.get("ticker")
-            markets = get_open_markets(event_ticker, private_key)
+    for event_ticker, markets in zip(event_tickers, markets_by_event):
 
-            event_markets = []
+        event_markets = []
+        event_rows = []
 
-            for market in markets:
+        for market in markets:
 
-                market_ticker = market.get("ticker")
-                if not market_ticker:
-                    continue
+            market_ticker = market.get("ticker")
+            if not market_ticker:
+                continue
 
-                suffix = market_ticker.split("-")[-1]
+            suffix = market_ticker.split("-")[-1]
 
-                if not (suffix.startswith("B") or suffix.startswith("T")):
-                    continue
+            if not (suffix.startswith("B") or suffix.startswith("T")):
+                continue
 
-                event_markets.append({
-                    "ticker": market_ticker,
-                    "suffix": suffix
-                })
+            # Range suffixes carry half-degree strikes (e.g. B72.5), so parse
+            # through float before truncating.
+            event_markets.append({
+                "ticker": market_ticker,
+                "suffix": suffix,
+                "value": int(float(suffix[1:]))
+            })
 
-            t_markets = sorted(
-                [m for m in event_markets if m["suffix"].startswith("T")],
-                key=lambda x: int(float(x["suffix"][1:]))
-            )
+        t_markets = sorted(
+            [m for m in event_markets if m["suffix"].startswith("T")],
+            key=operator.itemgetter("value")
+        )
+
+        b_markets = sorted(
+            [m for m in event_markets if m["suffix"].startswith("B")],
+            key=operator.itemgetter("value")
+        )
+
+        ordered_markets = []
+
+        if len(t_markets) > 0:
+            ordered_markets.append(t_markets[0])
+
+        ordered_markets.extend(b_markets)
+
+        if len(t_markets) > 1:
+            ordered_markets.append(t_markets[-1])
 
-            b_markets = sorted(
-                [m for m in event_markets if m["suffix"].startswith("B")],
-                key=lambda x: int(float(x["suffix"][1:]))
+        for idx, market_data in enumerate(ordered_markets):
+
+            market_ticker = market_data["ticker"]
+            suffix = market_data["suffix"]
+            order_number = idx + 1
+
+            bucket_type = None
+            lower_bound = None
+            upper_bound = None
+
+            value = market_data["value"]
+
+            if suffix.startswith("B"):
+                bucket_type = "range"
+                lower_bound = value
+                upper_bound = value + 1
+
+            elif suffix.startswith("T"):
+                if market_data == t_markets[0]:
+                    bucket_type = "below"
+                    upper_bound = value - 1
+                else:
+                    bucket_type = "above"
+                    lower_bound = value + 1
+
+            row = SnapshotRow(
+                timestamp_utc=timestamp,
+                event=event_ticker,
+                market=suffix,
+                bucket_type=bucket_type,
+                lower_bound=lower_bound,
+                upper_bound=upper_bound,
+                order=order_number
             )
 
-            ordered_markets = []
-
-            if len(t_markets) > 0:
-                ordered_markets.append(t_markets[0])
-
-            ordered_markets.extend(b_markets)
-
-            if len(t_markets) > 1:
-                ordered_markets.append(t_markets[-1])
-
-            for idx, market_data in enumerate(ordered_markets):
-
-                market_ticker = market_data["ticker"]
-                suffix = market_data["suffix"]
-                order_number = idx + 1
-
-                bucket_type = None
-                lower_bound = None
-                upper_bound = None
-
-                value = int(float(suffix[1:]))
-
-                if suffix.startswith("B"):
-                    bucket_type = "range"
-                    lower_bound = value
-                    upper_bound = value + 1
-
-                elif suffix.startswith("T"):
-                    if market_data == t_markets[0]:
-                        bucket_type = "below"
-                        upper_bound = value - 1
-                    else:
-                        bucket_type = "above"
-                        lower_bound = value + 1
-
-                orderbook = get_orderbook(market_ticker, private_key)
-                yes_bids, yes_asks = extract_depth(orderbook)
-
-                row = {
-                    "timestamp_utc": timestamp,
-                    "event": event_ticker,
-                    "market": suffix,
-                    "bucket_type": bucket_type,
-                    "lower_bound": lower_bound,
-                    "upper_bound": upper_bound,
-                    "order": order_number
-                }
-
-                for i in range(5):
-                    if i < len(yes_bids):
-                        row[f"bid{i+1}_price"] = yes_bids[i][0]
-                        row[f"bid{i+1}_qty"] = yes_bids[i][1]
-                    else:
-                        row[f"bid{i+1}_price"] = None
-                        row[f"bid{i+1}_qty"] = None
-
-                for i in range(5):
-                    if i < len(yes_asks):
-                        row[f"ask{i+1}_price"] = yes_asks[i][0]
-                        row[f"ask{i+1}_qty"] = yes_asks[i][1]
-                    else:
-                        row[f"ask{i+1}_price"] = None
-                        row[f"ask{i+1}_qty"] = None
-
-                rows_to_insert.append(row)
-
-    if rows_to_insert:
-        supabase.table(TABLE_NAME).insert(rows_to_insert).execute()
-        print(f"[{timestamp}] Inserted {len(rows_to_insert)} rows.")
+            event_rows.append((market_ticker, row))
+
+        pending_events.append(event_rows)
+
+    market_tickers = [
+        market_ticker for event_rows in pending_events for market_ticker, _ in event_rows
+    ]
+    await subscribe_markets(market_tickers)
+    prune_orderbook_cache(market_tickers)
+
+    queue = asyncio.Queue(maxsize=INSERT_QUEUE_SIZE)
+
+    # A failure anywhere cancels and awaits every fetch and insert task.
+    # Chunks already sent before the failure stay committed.
+    try:
+        async with asyncio.TaskGroup() as tasks:
+            tasks.create_task(produce_rows(
+                session, semaphore, queue, pending_events, private_key, auth_timestamp
+            ))
+            consumer = tasks.create_task(insert_rows_from_queue(supabase, queue))
+    except ExceptionGroup as group:
+        raise first_error(group) from group
+
+    inserted = consumer.result()
+
+    if inserted:
+        print(f"[{timestamp}] Inserted {inserted} rows.")
     else:
         print(f"[{timestamp}] No rows to insert.")
 
@@ -238,36 +667,57 @@ def run_snapshot():
 # 5-MINUTE ALIGNMENT LOOP
 # ==========================================================
 
-def sleep_until_next_5_min_mark():
+SNAPSHOT_INTERVAL = datetime.timedelta(minutes=5)
+
+async def sleep_until_next_5_min_mark(last_run=None):
 
     now = datetime.datetime.now(datetime.UTC)
     minute = now.minute
 
     next_minute = (math.floor(minute / 5) + 1) * 5
 
-    if next_minute == 60:
-        next_run = now.replace(hour=(now.hour + 1) % 24, minute=0, second=0, microsecond=0)
-    else:
-        next_run = now.replace(minute=next_minute, second=0, microsecond=0)
+    # timedelta rolls over the hour and the day, unlike replace(hour=...)
+    next_run = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(minutes=next_minute)
+
+    # A wall-clock step back (e.g. an NTP correction) must not re-run a slot.
+    if last_run is not None and next_run <= last_run:
+        next_run = last_run + SNAPSHOT_INTERVAL
 
     sleep_seconds = (next_run - now).total_seconds()
 
     print(f"Sleeping {int(sleep_seconds)} seconds until {next_run}")
-    time.sleep(max(0, sleep_seconds))
+    await asyncio.sleep(max(0, sleep_seconds))
+
+    return next_run
 
 
 # ==========================================================
 # ENTRY POINT
 # ==========================================================
 
-if __name__ == "__main__":
+async def main():
 
     print("Starting 5-minute aligned Kalshi weather ladder worker...")
 
-    while True:
-        sleep_until_next_5_min_mark()
+    async with create_session() as session:
 
-        try:
-            run_snapshot()
-        except Exception as e:
-            print("Error occurred:", e)
+        stream_task = asyncio.create_task(run_orderbook_stream())
+
+        last_run = None
+
+        while True:
+            last_run = await sleep_until_next_5_min_mark(last_run)
+            started = time.monotonic()
+
+            try:
+                await run_snapshot(session)
+            except Exception as e:
+                print("Error occurred:", e)
+
+            elapsed = time.monotonic() - started
+            if elapsed > SNAPSHOT_INTERVAL.total_seconds():
+                print(f"Snapshot took {int(elapsed)} seconds, skipping missed slots")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())